@@ -32,46 +32,41 @@ class AuthProtocol(ServerProtocol):
 
         self.logger.info("[AUTH SERVER] {} ({}) connected to address {}:{}".format(
             display_name, uuid, ip_addr, connect_port))
+        connection_token = ip_addr.split(".")[0]
         try:
-            connection_token = ip_addr.split(".")[0]
-            session = database_session.get_session()
-            token = session.query(AccountLinkToken).filter_by(token=connection_token).first()
-            if not token:
-                self.close("You have connected with an invalid token!")
-                session.close()
-                return
-            discord_account = session.query(DiscordAccount).filter_by(link_token_id=token.id).first()
-            if not discord_account:
-                self.close("You have connected with an invalid token!")
-                session.close()
-                return
-            if datetime.utcnow() < token.expiry:
-                # Check if they already have a linked account and are re-linking
-                if discord_account.minecraft_account_id != None:
-                    existing_account = session.query(MinecraftAccount).filter_by(
-                        id=discord_account.minecraft_account_id).first()
-                    self.logger.info("unlinking existing {} account and replacing it with {}".format(
-                        existing_account.minecraft_uuid, str(uuid)))
-                    session.delete(existing_account)
-                mc_account = MinecraftAccount(str(uuid), discord_account.id)
-                discord_account.minecraft_account = mc_account
-                session.add(mc_account)
-                session.delete(token)
-                session.commit()
-                session.close()
-                self.close("Your minecraft account has successfully been linked to your discord account!")
-                return
-            else:
-                session.delete(token)
-                session.commit()
-                session.close()
-                self.close("You have connected with an expired token! "
-                           "Please run the mc!register command again to get a new token.")
-                return
+            with database_session.session_scope() as session:
+                token = session.query(AccountLinkToken).filter_by(token=connection_token).first()
+                if not token:
+                    self.close("You have connected with an invalid token!")
+                    return
+                discord_account = session.query(DiscordAccount).filter_by(link_token_id=token.id).first()
+                if not discord_account:
+                    self.close("You have connected with an invalid token!")
+                    return
+                if datetime.utcnow() < token.expiry:
+                    # Check if they already have a linked account and are re-linking
+                    if discord_account.minecraft_account_id != None:
+                        existing_account = session.query(MinecraftAccount).filter_by(
+                            id=discord_account.minecraft_account_id).first()
+                        self.logger.info("unlinking existing {} account and replacing it with {}".format(
+                            existing_account.minecraft_uuid, str(uuid)))
+                        session.delete(existing_account)
+                    mc_account = MinecraftAccount(str(uuid), discord_account.id)
+                    discord_account.minecraft_account = mc_account
+                    session.add(mc_account)
+                    session.delete(token)
+                    session.commit()
+                    self.close("Your minecraft account has successfully been linked to your discord account!")
+                    return
+                else:
+                    session.delete(token)
+                    session.commit()
+                    self.close("You have connected with an expired token! "
+                               "Please run the mc!register command again to get a new token.")
+                    return
 
         except Exception as e:
             self.logger.error(e)
-            session.close()
 
         # Kick the player.
         self.close("This shouldn't happen!")
@@ -79,4 +74,4 @@ class AuthProtocol(ServerProtocol):
 
 class AuthFactory(ServerFactory):
     protocol = AuthProtocol
-motd = "Auth Server"
+    motd = "Auth Server"
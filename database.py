@@ -11,9 +11,11 @@ class DiscordChannel(Base):
 
     id = Column(Integer, primary_key=True)
     channel_id = Column(Integer)
+    webhook_url = Column(String)
 
-    def __init__(self, channel_id):
+    def __init__(self, channel_id, webhook_url=None):
         self.channel_id = channel_id
+        self.webhook_url = webhook_url
 
 
 class AccountLinkToken(Base):
@@ -58,4 +60,4 @@ class DiscordAccount(Base):
         "MinecraftAccount", uselist=False, foreign_keys=[minecraft_account_id], back_populates="discord_account")
 
     def __init__(self, discord_id):
-self.discord_id = discord_id
+        self.discord_id = discord_id
@@ -1,18 +1,41 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 _engine = None
+_session_factory = None
 Base = declarative_base()
 
 
 def initialize(config):
-    global _engine
+    global _engine, _session_factory
     _connection_string = config.database_connection_string
     _engine = create_engine(_connection_string)
     Base.metadata.create_all(_engine)
+    _add_webhook_url_column()
+    # Built once, sessions check their connections out of the engine's pool
+    _session_factory = sessionmaker(bind=_engine, expire_on_commit=False)
+
+
+def _add_webhook_url_column():
+    # discord_channels.webhook_url was added after the table first shipped, create_all() won't add it to an existing one
+    columns = set(column["name"] for column in inspect(_engine).get_columns("discord_channels"))
+    if "webhook_url" not in columns:
+        with _engine.begin() as connection:
+            connection.execute(text("ALTER TABLE discord_channels ADD COLUMN webhook_url VARCHAR"))
 
 
 def get_session():
-    Session = sessionmaker(bind=_engine)()
-return Session
+    return _session_factory()
+
+
+@contextmanager
+def session_scope():
+    # The session is closed (and its connection returned to the pool) on every way out of the block
+    session = _session_factory()
+    try:
+        yield session
+    finally:
+        session.close()
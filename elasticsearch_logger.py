@@ -1,6 +1,9 @@
+import atexit
+import json
 import time
 from enum import Enum
 import logging
+from threading import Thread, Lock, Event
 
 import requests
 
@@ -9,6 +12,23 @@ _password = None
 _auth = None
 _url = None
 
+# Documents are buffered and sent with the bulk API instead of one request per event
+FLUSH_INTERVAL = 0.5
+FLUSH_SIZE = 100
+# Failed batches are kept for the next flush, up to this many documents (oldest are dropped first)
+MAX_BUFFERED = 10000
+# After a failed flush nothing is sent until the backoff (in seconds) runs out, it doubles on every failure
+RETRY_INITIAL_DELAY = 1
+RETRY_MAX_DELAY = 60
+_retry_delay = 0
+_retry_at = 0
+# (connect, read) in seconds, a stalled connection would otherwise block the flusher thread and shutdown forever
+REQUEST_TIMEOUT = (3, 10)
+_session = requests.Session()
+_buffer = []
+_buffer_lock = Lock()
+_flush_event = Event()
+
 log = logging.getLogger("bridge.elasticsearch")
 
 
@@ -19,6 +39,9 @@ def initialize(config):
         _username = config.es_username
         _password = config.es_password
     _url = config.es_url
+    flusher_thread = Thread(target=_run_flusher, daemon=True)
+    flusher_thread.start()
+    atexit.register(flush)
 
 
 def log_connection(uuid, reason, count=0):
@@ -35,7 +58,7 @@ def log_connection(uuid, reason, count=0):
             "time": (lambda: int(round(time.time() * 1000)))(),
             "reason": ConnectionReason(reason).name,
         }
-    post_request("connections/_doc/", es_payload)
+    queue_document("connections", es_payload)
 
 
 def log_chat_message(uuid, display_name, message, message_unformatted):
@@ -46,7 +69,7 @@ def log_chat_message(uuid, display_name, message, message_unformatted):
         "message_unformatted": message_unformatted,
         "time": (lambda: int(round(time.time() * 1000)))(),
     }
-    post_request("chat_messages/_doc/", es_payload)
+    queue_document("chat_messages", es_payload)
 
 
 def log_raw_message(type, message):
@@ -55,19 +78,103 @@ def log_raw_message(type, message):
         "type": type,
         "message": message,
     }
-    post_request("raw_messages/_doc/", es_payload)
+    queue_document("raw_messages", es_payload)
+
+
+def queue_document(index, payload):
+    with _buffer_lock:
+        _buffer.append((index, payload))
+        if len(_buffer) >= FLUSH_SIZE:
+            _flush_event.set()
+
+
+def flush():
+    # Sends FLUSH_SIZE documents at a time, stopping at the first batch that fails
+    while True:
+        with _buffer_lock:
+            pending = _buffer[:FLUSH_SIZE]
+            del _buffer[:FLUSH_SIZE]
+        if not pending or not _send_batch(pending):
+            return
+
+
+def _send_batch(pending):
+    lines = []
+    for index, payload in pending:
+        lines.append(json.dumps({"index": {"_index": index, "_type": "_doc"}}))
+        lines.append(json.dumps(payload))
+    try:
+        response = post_request("_bulk", "\n".join(lines) + "\n")
+        response.raise_for_status()
+        result = response.json()
+    except Exception as e:
+        log.warning("Failed to send {} documents to elasticsearch, retrying later: {}".format(len(pending), e))
+        _requeue(pending)
+        _back_off()
+        return False
+    if result.get("errors"):
+        statuses = [next(iter(item.values()))["status"] for item in result["items"]]
+        # Only rejections that can succeed later are retried, a bad document would fail again every time
+        retry = [document for document, status in zip(pending, statuses) if status == 429 or status >= 500]
+        log.warning("Elasticsearch rejected {} of {} documents, retrying {} of them later".format(
+            sum(1 for status in statuses if status >= 300), len(pending), len(retry)))
+        if retry:
+            _requeue(retry)
+            _back_off()
+            return False
+    _reset_backoff()
+    return True
+
+
+def _back_off():
+    global _retry_delay, _retry_at
+    _retry_delay = min(_retry_delay * 2, RETRY_MAX_DELAY) if _retry_delay else RETRY_INITIAL_DELAY
+    _retry_at = time.monotonic() + _retry_delay
+
+
+def _reset_backoff():
+    global _retry_delay, _retry_at
+    _retry_delay = 0
+    _retry_at = 0
+
+
+def _requeue(documents):
+    with _buffer_lock:
+        _buffer[:0] = documents
+        overflow = len(_buffer) - MAX_BUFFERED
+        if overflow > 0:
+            del _buffer[:overflow]
+    if overflow > 0:
+        log.warning("Dropped {} buffered documents because elasticsearch is not keeping up".format(overflow))
+
+
+def _run_flusher():
+    while True:
+        _flush_event.wait(FLUSH_INTERVAL)
+        _flush_event.clear()
+        # New documents keep setting the event, they don't get to cut a backoff short
+        delay = _retry_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            flush()
+        except Exception as e:
+            log.error("Failed to send buffered documents to elasticsearch: {}".format(e), exc_info=True)
 
 
-def post_request(endpoint, payload):
+def post_request(endpoint, data):
     the_url = "{}{}".format(_url, endpoint)
+    headers = {"Content-Type": "application/x-ndjson"}
     if _auth:
-        post = requests.post(the_url, auth=(_username, _password), json=payload)
+        post = _session.post(
+            the_url, auth=(_username, _password), data=data, headers=headers, timeout=REQUEST_TIMEOUT)
     else:
-        post = requests.post(the_url, json=payload)
+        post = _session.post(the_url, data=data, headers=headers, timeout=REQUEST_TIMEOUT)
     log.debug(post.text)
+    return post
 
 
 class ConnectionReason(Enum):
     CONNECTED = "CONNECTED"
     DISCONNECTED = "DISCONNECTED"
-SEEN = "SEEN"
+    SEEN = "SEEN"
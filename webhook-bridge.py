@@ -5,15 +5,22 @@ from __future__ import print_function
 import sys
 import re
 from enum import Enum
+from itertools import chain
+from functools import lru_cache
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import time
 import logging
 import random
 import string
 import uuid
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 from config import Configuration
 from database import DiscordChannel, AccountLinkToken, DiscordAccount
 import database_session
@@ -27,60 +34,268 @@ from minecraft.networking.packets import clientbound, serverbound
 
 import discord
 import asyncio
+import aiohttp
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from mcstatus import MinecraftServer
 
-from bidict import bidict
+from cachetools import LRUCache, TTLCache
 
 log = logging.getLogger("bridge")
 
+# Keep-alive session for the Mojang API so repeated lookups skip the TCP+TLS handshake
+MOJANG_SESSION = requests.Session()
+MOJANG_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=2))
+MOJANG_SESSION.headers.update({"User-Agent": "minecraft-discord-bridge"})
+
+# The bot's event loop, messages from the Minecraft side are handed over to it
+BOT_LOOP = None
+# All webhook URLs live on discord.com, so one pool lets every delivery reuse the same sockets.
+# Created on the bot's loop in on_ready.
+WEBHOOK_SESSION = None
+# pyCraft writes are blocking socket I/O, a single writer thread keeps them off the event loop and in order
+MINECRAFT_WRITER = ThreadPoolExecutor(max_workers=1)
+# Only ever touched from MINECRAFT_WRITER, so one packet can be refilled for every chat message
+CHAT_PACKET = serverbound.play.ChatPacket()
+
 SESSION_TOKEN = ""
-UUID_CACHE = bidict()
-WEBHOOKS = []
+# Channel ids the bot is chatting in, mirrors the discord_channels table.
+# Rebuilt rather than mutated so every reader sees a consistent snapshot.
+BRIDGED_CHANNELS = frozenset()
+# Players currently on the server, filled in from the tab list
+UUID_TO_NAME = {}
+NAME_TO_UUID = {}
+# Mojang API results, failed lookups are only remembered briefly so we don't hammer a rate-limited API
+MOJANG_NAME_CACHE = TTLCache(maxsize=10000, ttl=86400)
+MOJANG_UUID_CACHE = TTLCache(maxsize=10000, ttl=86400)
+MOJANG_MISS_CACHE = TTLCache(maxsize=1000, ttl=60)
+MOJANG_CACHE_LOCK = Lock()
+# DM channels by user id, so repeated errors to the same user don't go through create_dm() again
+DM_CHANNELS = LRUCache(maxsize=1000)
+# The "_minecraft" webhook of every bridged channel, keyed by channel id
+CHANNEL_WEBHOOKS = {}
 BOT_USERNAME = ""
+BOT_USERNAME_LOWER = ""
 NEXT_MESSAGE_TIME = datetime.now(timezone.utc)
 PREVIOUS_MESSAGE = ""
-PLAYER_LIST = bidict()
-PREVIOUS_PLAYER_LIST = bidict()
+PLAYER_LIST = {}
+PREVIOUS_PLAYER_LIST = {}
+# mc!tab's player list, rebuilt only after the tab list changes
+PLAYER_LIST_DISPLAY = None
+PLAYER_LIST_DISPLAY_LOCK = Lock()
 ACCEPT_JOIN_EVENTS = False
 TAB_HEADER = ""
 TAB_FOOTER = ""
+# Servers resend an unchanged header/footer constantly, so keep the raw packet text to skip repeats
+TAB_HEADER_RAW = None
+TAB_FOOTER_RAW = None
+TAB_HEADER_DISPLAY = ""
+TAB_FOOTER_DISPLAY = ""
+
+# Discord-bound messages are queued per channel and coalesced, Discord allows 30 requests a minute per webhook
+DISCORD_MESSAGE_LIMIT = 2000
+OUTBOUND_FLUSH_INTERVAL = 0.5
+OUTBOUND_BATCH_SIZE = 10
+WEBHOOK_RATE = 30
+WEBHOOK_RATE_PERIOD = 60
+OUTBOUND_QUEUES = {}
+
+# Exponential backoff (in seconds) while waiting for the Minecraft server to come back
+SERVER_CHECK_INITIAL_DELAY = 5
+SERVER_CHECK_MAX_DELAY = 60
+
+# The concrete classes discord.py hands us, checked directly instead of through the abc registry.
+# Messages only ever arrive in text channels on the guild side.
+USER_TYPES = (discord.User, discord.Member)
+PRIVATE_CHANNEL_TYPES = (discord.DMChannel, discord.GroupChannel)
+
+CHAT_PATTERN = re.compile("<(.*?)> (.*)", re.M | re.I)
+# Compiled once the bot's username is known
+BOT_MESSAGE_PATTERN = None
+
+
+def cache_set(player_uuid, username):
+    UUID_TO_NAME[player_uuid] = username
+    NAME_TO_UUID[username] = player_uuid
+
+
+def cache_delete(player_uuid):
+    username = UUID_TO_NAME.pop(player_uuid, None)
+    if username is not None:
+        NAME_TO_UUID.pop(username, None)
 
 
 def mc_uuid_to_username(uuid):
-    if uuid not in UUID_CACHE:
-        try:
-            short_uuid = uuid.replace("-", "")
-            mojang_response = requests.get("https://api.mojang.com/user/profiles/{}/names".format(short_uuid)).json()
-            if len(mojang_response) > 1:
-                # Multiple name changes
-                player_username = mojang_response[-1]["name"]
-            else:
-                # Only one name
-                player_username = mojang_response[0]["name"]
-            UUID_CACHE[uuid] = player_username
+    player_username = UUID_TO_NAME.get(uuid)
+    if player_username is not None:
+        return player_username
+    with MOJANG_CACHE_LOCK:
+        player_username = MOJANG_NAME_CACHE.get(uuid)
+        if player_username is not None or uuid in MOJANG_MISS_CACHE:
             return player_username
-        except Exception as e:
-            log.error(e, exc_info=True)
-            log.error("Failed to lookup {}'s username using the Mojang API.".format(uuid))
-    else:
-        return UUID_CACHE[uuid]
+    try:
+        short_uuid = uuid.replace("-", "")
+        mojang_response = MOJANG_SESSION.get("https://api.mojang.com/user/profiles/{}/names".format(short_uuid))
+        mojang_response.raise_for_status()
+        mojang_response = mojang_response.json()
+        if len(mojang_response) > 1:
+            # Multiple name changes
+            player_username = mojang_response[-1]["name"]
+        else:
+            # Only one name
+            player_username = mojang_response[0]["name"]
+        with MOJANG_CACHE_LOCK:
+            MOJANG_NAME_CACHE[uuid] = player_username
+        return player_username
+    except Exception as e:
+        log.error(e, exc_info=True)
+        log.error("Failed to lookup {}'s username using the Mojang API.".format(uuid))
+        with MOJANG_CACHE_LOCK:
+            MOJANG_MISS_CACHE[uuid] = True
+
 
-    
 def mc_username_to_uuid(username):
-    if username not in UUID_CACHE.inv:
-        try:
-            player_uuid = requests.get(
-                "https://api.mojang.com/users/profiles/minecraft/{}".format(username)).json()["id"]
-            long_uuid = uuid.UUID(player_uuid)
-            UUID_CACHE.inv[username] = str(long_uuid)
+    player_uuid = NAME_TO_UUID.get(username)
+    if player_uuid is not None:
+        return player_uuid
+    with MOJANG_CACHE_LOCK:
+        player_uuid = MOJANG_UUID_CACHE.get(username)
+        if player_uuid is not None or username in MOJANG_MISS_CACHE:
             return player_uuid
-        except:
-            log.error("Failed to lookup {}'s UUID using the Mojang API.".format(username))
+    try:
+        mojang_response = MOJANG_SESSION.get(
+            "https://api.mojang.com/users/profiles/minecraft/{}".format(username))
+        # Unknown names come back as an empty 204
+        mojang_response.raise_for_status()
+        player_uuid = str(uuid.UUID(mojang_response.json()["id"]))
+        with MOJANG_CACHE_LOCK:
+            MOJANG_UUID_CACHE[username] = player_uuid
+        return player_uuid
+    except:
+        log.error("Failed to lookup {}'s UUID using the Mojang API.".format(username))
+        with MOJANG_CACHE_LOCK:
+            MOJANG_MISS_CACHE[username] = True
+
+
+@lru_cache(maxsize=1024)
+def get_avatar_url(player_uuid):
+    return f"https://visage.surgeplay.com/face/160/{player_uuid}"
+
+
+def invalidate_player_list_display():
+    global PLAYER_LIST_DISPLAY
+    with PLAYER_LIST_DISPLAY_LOCK:
+        PLAYER_LIST_DISPLAY = None
+
+
+def get_player_list_display():
+    global PLAYER_LIST_DISPLAY
+    with PLAYER_LIST_DISPLAY_LOCK:
+        if PLAYER_LIST_DISPLAY is None:
+            PLAYER_LIST_DISPLAY = escape_markdown(strip_colour(", ".join(PLAYER_LIST.values())))
+        return PLAYER_LIST_DISPLAY
+
+
+def join_chat_lines(lines):
+    # Split the lines into as few messages as possible without going over Discord's length limit
+    chunk = []
+    length = 0
+    for line in lines:
+        if chunk and length + len(line) > DISCORD_MESSAGE_LIMIT:
+            yield "\n".join(chunk)
+            chunk = []
+            length = 0
+        chunk.append(line)
+        length += len(line) + 1
+    if chunk:
+        yield "\n".join(chunk)
+
+
+def coalesce_messages(messages):
+    # Consecutive plain messages from the same sender are merged, anything with embeds goes out on its own
+    run = []
+    for message in messages:
+        if run and (message.get("embeds") or
+                    (message["username"], message["avatar_url"]) != (run[0]["username"], run[0]["avatar_url"])):
+            for content in join_chat_lines([queued["content"] for queued in run]):
+                yield dict(run[0], content=content)
+            run = []
+        if message.get("embeds"):
+            yield message
+        else:
+            run.append(message)
+    for content in join_chat_lines([queued["content"] for queued in run]):
+        yield dict(run[0], content=content)
+
+
+class TokenBucket(object):
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def gather_logged(coroutines, action):
+    # A failing coroutine is logged and gives None rather than taking the others down with it
+    async def logged(coroutine):
+        try:
+            return await coroutine
+        except Exception as e:
+            log.error("Failed to {}: {}".format(action, e), exc_info=True)
+
+    if hasattr(asyncio, "TaskGroup"):
+        async with asyncio.TaskGroup() as group:
+            tasks = [group.create_task(logged(coroutine)) for coroutine in coroutines]
+        return [task.result() for task in tasks]
+    return await asyncio.gather(*(logged(coroutine) for coroutine in coroutines))
+
+
+async def fetch_channel_webhook(discord_channel):
+    channel_webhooks = await discord_channel.webhooks()
+    for webhook in channel_webhooks:
+        log.debug("Found webhook {} in channel {}".format(webhook.name, discord_channel.name))
+        if webhook.name == "_minecraft":
+            break
     else:
-        return UUID_CACHE.inv[username]
+        # Create the hook
+        webhook = await discord_channel.create_webhook(name="_minecraft")
+    return webhook_from_url(webhook.url)
+
+
+def webhook_from_url(url):
+    # Send through the shared session so both directions reuse the same keep-alive connections
+    return discord.Webhook.from_url(url, adapter=discord.AsyncWebhookAdapter(WEBHOOK_SESSION))
+
+
+def remember_channel_webhook(channel_id, webhook):
+    CHANNEL_WEBHOOKS[channel_id] = webhook
+    with database_session.session_scope() as session:
+        session.query(DiscordChannel).filter_by(channel_id=channel_id).update({"webhook_url": webhook.url})
+        session.commit()
+
+
+async def get_dm_channel(user):
+    dm_channel = DM_CHANNELS.get(user.id)
+    if dm_channel is None:
+        dm_channel = user.dm_channel or await user.create_dm()
+        DM_CHANNELS[user.id] = dm_channel
+    return dm_channel
+
 
-        
 def get_discord_help_string():
     help_str = ("Admin commands:\n"
                 "`mc!chathere`: Starts outputting server messages in this channel\n"
@@ -93,33 +308,61 @@ def get_discord_help_string():
 
 
 # https://stackoverflow.com/questions/33404752/removing-emojis-from-a-string-in-python
-def remove_emoji(string):
-    emoji_pattern = re.compile(
-        "["
-        u"\U0001F600-\U0001F64F"  # emoticons
-        u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-        u"\U0001F680-\U0001F6FF"  # transport & map symbols
-        u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-        u"\U0001F900-\U0001FAFF"  # CJK Compatibility Ideographs
-        # u"\U00002702-\U000027B0"
-        # u"\U000024C2-\U0001F251"
-        "]+", flags=re.UNICODE)
-    return emoji_pattern.sub(r'', string)
+# str.translate does a single pass in C, which beats the regex engine on emoji-free messages
+EMOJI_TABLE = dict.fromkeys(chain(
+    range(0x1F600, 0x1F650),  # emoticons
+    range(0x1F300, 0x1F600),  # symbols & pictographs
+    range(0x1F680, 0x1F700),  # transport & map symbols
+    range(0x1F1E0, 0x1F200),  # flags (iOS)
+    range(0x1F900, 0x1FB00),  # CJK Compatibility Ideographs
+), None)
+
+# Every character is mapped in one pass, so escaping slashes can't be escaped again
+MARKDOWN_TABLE = str.maketrans({
+    "\\": "\\\\",
+    "_": "\\_",
+    "*": "\\*",
+})
+
+
+class MinecraftOutTable(dict):
+    # Drops emoji and turns any other non-ASCII character into "?" for Minecraft's chat
+    def __missing__(self, codepoint):
+        if codepoint < 128:
+            raise LookupError(codepoint)
+        # Remember the replacement so the next lookup for this character stays in C
+        self[codepoint] = "?"
+        return "?"
+
+
+MINECRAFT_OUT_TABLE = MinecraftOutTable(EMOJI_TABLE)
+
+# Emoji removal, mention defusing and markdown escaping for Minecraft chat, all in a single pass
+DISCORD_OUT_TABLE = {**EMOJI_TABLE, ord("@"): "@\N{zero width space}", **MARKDOWN_TABLE}
+
+
+def to_minecraft_chat(string):
+    # Most messages are plain ASCII already and need no translation at all
+    if not string.isascii():
+        string = string.translate(MINECRAFT_OUT_TABLE)
+    return string.strip()
 
 
 def escape_markdown(string):
-    # Absolutely needs to go first or it will replace our escaping slashes!
-    string = string.replace("\\", "\\\\")
-    string = string.replace("_", "\\_")
-    string = string.replace("*", "\\*")
-    return string
+    return string.translate(MARKDOWN_TABLE)
+
+
+def to_discord_chat(string):
+    return string.strip().translate(DISCORD_OUT_TABLE)
+
+
+COLOUR_PATTERN = re.compile(
+    u"\U000000A7"  # selection symbol
+    ".", flags=re.UNICODE)
 
 
 def strip_colour(string):
-    colour_pattern = re.compile(
-        u"\U000000A7"  # selection symbol
-        ".", flags=re.UNICODE)
-    return colour_pattern.sub(r'', string)
+    return COLOUR_PATTERN.sub(r'', string)
 
 
 def setup_logging(level):
@@ -153,6 +396,15 @@ def run_auth_server(port):
         reactor.stop()
 
 
+def write_chat_packet(connection, text):
+    # Forced so the packet is serialised right away instead of being queued by reference for the networking thread
+    if not connection.connected:
+        log.warning("Dropped a chat message because the minecraft connection is down: %s", text)
+        return
+    CHAT_PACKET.message = text
+    connection.write_packet(CHAT_PACKET, force=True)
+
+
 def generate_random_auth_token(length):
     letters = string.ascii_lowercase + string.digits + string.ascii_uppercase
     return ''.join(random.choice(letters) for i in range(length))
@@ -165,8 +417,18 @@ class ChatType(Enum):
     GAME_INFO = 2  # Displayed above the hotbar in vanilla clients.
 
 
+class BridgeClient(discord.Client):
+    async def close(self):
+        await super().close()
+        if WEBHOOK_SESSION is not None:
+            await WEBHOOK_SESSION.close()
+
+
 def main():
-    global BOT_USERNAME
+    global BOT_USERNAME, BOT_USERNAME_LOWER, BOT_MESSAGE_PATTERN, BOT_LOOP
+    # Has to happen before the discord client is created, it grabs the event loop on construction
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     config = Configuration("config.json")
     setup_logging(config.logging_level)
 
@@ -182,14 +444,13 @@ def main():
         global PLAYER_LIST, PREVIOUS_PLAYER_LIST, ACCEPT_JOIN_EVENTS
         PREVIOUS_PLAYER_LIST = PLAYER_LIST.copy()
         ACCEPT_JOIN_EVENTS = False
-        PLAYER_LIST = bidict()
+        PLAYER_LIST = {}
+        invalidate_player_list_display()
         if connection.connected:
             log.info("Forced a disconnection because the connection is still connected.")
             connection.disconnect(immediate=True)
         time.sleep(15)
-        while not is_server_online():
-            log.info('Not reconnecting to server because it appears to be offline.')
-            time.sleep(15)
+        wait_for_server('Not reconnecting to server because it appears to be offline.')
         log.info('Reconnecting.')
         connection.connect()
 
@@ -200,26 +461,34 @@ def main():
         log.error("A minecraft exception occured! {}:".format(exception), exc_info=exc_info)
         handle_disconnect()
 
+    # Looked up once so the SRV record isn't resolved again on every check
+    minecraft_server = MinecraftServer.lookup("{}:{}".format(config.mc_server, config.mc_port))
+
     def is_server_online():
-        server = MinecraftServer.lookup("{}:{}".format(config.mc_server, config.mc_port))
         try:
-            status = server.status()
-            del status
+            # A ping is a single round-trip and skips the status JSON entirely
+            minecraft_server.ping()
             return True
-        except ConnectionRefusedError:
+        # Covers refused connections, socket.timeout and mcstatus' IOError when a half-up server sends nothing back
+        except OSError:
             return False
         # AttributeError: 'TCPSocketConnection' object has no attribute 'socket'
         # This might not be required as it happens upstream
         except AttributeError:
             return False
 
+    def wait_for_server(offline_message):
+        delay = SERVER_CHECK_INITIAL_DELAY
+        while not is_server_online():
+            log.info(offline_message)
+            time.sleep(delay + random.uniform(0, delay * 0.1))
+            delay = min(delay * 2, SERVER_CHECK_MAX_DELAY)
+
     log.debug("Checking if the server {} is online before connecting.")
 
     if not config.mc_online:
         log.info("Connecting in offline mode...")
-        while not is_server_online():
-            log.info('Not connecting to server because it appears to be offline.')
-            time.sleep(15)
+        wait_for_server('Not connecting to server because it appears to be offline.')
         BOT_USERNAME = config.mc_username
         connection = Connection(
             config.mc_server, config.mc_port, username=config.mc_username,
@@ -233,15 +502,32 @@ def main():
             sys.exit()
         BOT_USERNAME = auth_token.profile.name
         log.info("Logged in as %s..." % auth_token.profile.name)
-        while not is_server_online():
-            log.info('Not connecting to server because it appears to be offline.')
-            time.sleep(15)
+        wait_for_server('Not connecting to server because it appears to be offline.')
         connection = Connection(
             config.mc_server, config.mc_port, auth_token=auth_token,
             handle_exception=minecraft_handle_exception)
 
+    BOT_USERNAME_LOWER = BOT_USERNAME.lower()
+    BOT_MESSAGE_PATTERN = re.compile("<{}> (.*?): (.*)".format(re.escape(BOT_USERNAME_LOWER)), re.M | re.I)
+
     # Initialize the discord part
-    discord_bot = discord.Client()
+    discord_bot = BridgeClient()
+    BOT_LOOP = discord_bot.loop
+
+    def queue_discord_message(channel_id, message):
+        queue = OUTBOUND_QUEUES.get(channel_id)
+        if queue is None:
+            queue = OUTBOUND_QUEUES[channel_id] = asyncio.Queue()
+            BOT_LOOP.create_task(run_outbound_queue(channel_id, queue))
+        queue.put_nowait(message)
+
+    def queue_bridged_message(message):
+        for channel_id in BRIDGED_CHANNELS:
+            queue_discord_message(channel_id, message)
+
+    def relay_from_minecraft(message):
+        # Called from the minecraft networking thread, the queues belong to the bot's loop
+        BOT_LOOP.call_soon_threadsafe(queue_bridged_message, message)
 
     def register_handlers(connection):
         connection.register_packet_listener(
@@ -263,11 +549,17 @@ def main():
             handle_player_list_header_and_footer_update, clientbound.play.PlayerListHeaderAndFooterPacket)
 
     def handle_player_list_header_and_footer_update(header_footer_packet):
-        global TAB_FOOTER, TAB_HEADER
+        global TAB_FOOTER, TAB_HEADER, TAB_HEADER_RAW, TAB_FOOTER_RAW, TAB_HEADER_DISPLAY, TAB_FOOTER_DISPLAY
         log.debug("Got Tablist H/F Update: header={}".format(header_footer_packet.header))
         log.debug("Got Tablist H/F Update: footer={}".format(header_footer_packet.footer))
-        TAB_HEADER = json.loads(header_footer_packet.header)["text"]
-        TAB_FOOTER = json.loads(header_footer_packet.footer)["text"]
+        if header_footer_packet.header != TAB_HEADER_RAW:
+            TAB_HEADER = json_loads(header_footer_packet.header)["text"]
+            TAB_HEADER_DISPLAY = escape_markdown(strip_colour(TAB_HEADER))
+            TAB_HEADER_RAW = header_footer_packet.header
+        if header_footer_packet.footer != TAB_FOOTER_RAW:
+            TAB_FOOTER = json_loads(header_footer_packet.footer)["text"]
+            TAB_FOOTER_DISPLAY = escape_markdown(strip_colour(TAB_FOOTER))
+            TAB_FOOTER_RAW = header_footer_packet.footer
 
     def handle_tab_list(tab_list_packet):
         global ACCEPT_JOIN_EVENTS
@@ -278,23 +570,21 @@ def main():
                     "Processing AddPlayerAction tab list packet, name: {}, uuid: {}".format(action.name, action.uuid))
                 username = action.name
                 player_uuid = action.uuid
-                if action.name not in PLAYER_LIST.inv:
-                    PLAYER_LIST.inv[action.name] = action.uuid
+                if action.uuid not in PLAYER_LIST:
+                    PLAYER_LIST[action.uuid] = action.name
+                    invalidate_player_list_display()
                 else:
                     # Sometimes we get a duplicate add packet on join idk why
                     return
-                if action.name not in UUID_CACHE.inv:
-                    UUID_CACHE.inv[action.name] = action.uuid
+                if action.name not in NAME_TO_UUID:
+                    cache_set(action.uuid, action.name)
                 # Initial tablist backfill
                 if ACCEPT_JOIN_EVENTS:
-                    webhook_payload = {
+                    relay_from_minecraft({
                         'username': username,
-                        'avatar_url':  "https://visage.surgeplay.com/face/160/{}".format(player_uuid),
-                        'content': '',
-                        'embeds': [{'color': 65280, 'title': '**Joined the game**'}]
-                    }
-                    for webhook in WEBHOOKS:
-                        post = requests.post(webhook,json=webhook_payload)
+                        'avatar_url': get_avatar_url(player_uuid),
+                        'embeds': [discord.Embed(colour=65280, title='**Joined the game**')]
+                    })
                     if config.es_enabled:
                         el.log_connection(
                             uuid=action.uuid, reason=el.ConnectionReason.CONNECTED, count=len(PLAYER_LIST))
@@ -304,10 +594,11 @@ def main():
                     if action.name == BOT_USERNAME:
                         ACCEPT_JOIN_EVENTS = True
                         if config.es_enabled:
-                            diff = set(PREVIOUS_PLAYER_LIST.keys()) - set(PLAYER_LIST.keys())
-                            for idx, uuid in enumerate(diff):
-                                el.log_connection(uuid=uuid, reason=el.ConnectionReason.DISCONNECTED,
-                                              count=len(PREVIOUS_PLAYER_LIST) - (idx + 1))
+                            diff = PREVIOUS_PLAYER_LIST.keys() - PLAYER_LIST.keys()
+                            count = len(PREVIOUS_PLAYER_LIST)
+                            for uuid in diff:
+                                count -= 1
+                                el.log_connection(uuid=uuid, reason=el.ConnectionReason.DISCONNECTED, count=count)
                         # Don't bother announcing the bot's own join message (who cares) but log it for analytics still
                         if config.es_enabled:
                             el.log_connection(
@@ -319,43 +610,38 @@ def main():
                 log.debug("Processing RemovePlayerAction tab list packet, uuid: {}".format(action.uuid))
                 username = mc_uuid_to_username(action.uuid)
                 player_uuid = action.uuid
-                webhook_payload = {
+                relay_from_minecraft({
                     'username': username,
-                    'avatar_url':  "https://visage.surgeplay.com/face/160/{}".format(player_uuid),
-                    'content': '',
-                    'embeds': [{'color': 16711680, 'title': '**Left the game**'}]
-                }
-                for webhook in WEBHOOKS:
-                    post = requests.post(webhook,json=webhook_payload)
-                del UUID_CACHE[action.uuid]
+                    'avatar_url': get_avatar_url(player_uuid),
+                    'embeds': [discord.Embed(colour=16711680, title='**Left the game**')]
+                })
+                cache_delete(action.uuid)
                 del PLAYER_LIST[action.uuid]
+                invalidate_player_list_display()
                 if config.es_enabled:
                     el.log_connection(uuid=action.uuid, reason=el.ConnectionReason.DISCONNECTED, count=len(PLAYER_LIST))
 
     def handle_join_game(join_game_packet):
         global PLAYER_LIST
         log.info('Connected.')
-        PLAYER_LIST = bidict()
+        PLAYER_LIST = {}
+        invalidate_player_list_display()
 
     def handle_chat(chat_packet):
-        json_data = json.loads(chat_packet.json_data)
+        json_data = json_loads(chat_packet.json_data)
         if "extra" not in json_data:
             return
-        chat_string = ""
-        for chat_component in json_data["extra"]:
-            chat_string += chat_component["text"] 
+        chat_string = "".join([chat_component["text"] for chat_component in json_data["extra"]])
         
         # Handle chat message
-        regexp_match = re.match("<(.*?)> (.*)", chat_string, re.M|re.I)
+        regexp_match = CHAT_PATTERN.match(chat_string)
         if regexp_match:
             username = regexp_match.group(1)
             original_message = regexp_match.group(2)
-            player_uuid = mc_username_to_uuid(username)
-            if username.lower() == BOT_USERNAME.lower():
+            if username.lower() == BOT_USERNAME_LOWER:
                 # Don't relay our own messages
                 if config.es_enabled:
-                    bot_message_match = re.match("<{}> (.*?): (.*)".format(
-                        BOT_USERNAME.lower()), chat_string, re.M | re.I)
+                    bot_message_match = BOT_MESSAGE_PATTERN.match(chat_string)
                     if bot_message_match:
                         el.log_chat_message(
                             uuid=mc_username_to_uuid(bot_message_match.group(1)),
@@ -364,16 +650,16 @@ def main():
                             message_unformatted=chat_string)
                         el.log_raw_message(type=ChatType(chat_packet.position).name, message=chat_packet.json_data)
                 return
-            log.info("Incoming message from minecraft: Username: {} Message: {}".format(username, original_message))
-            log.debug("msg: {}".format(repr(original_message)))
-            message = escape_markdown(remove_emoji(original_message.strip().replace("@", "@\N{zero width space}")))
-            webhook_payload = {
+            log.info("Incoming message from minecraft: Username: %s Message: %s", username, original_message)
+            log.debug("msg: %r", original_message)
+            # Anyone chatting is almost always in the tab list, so this rarely leaves the process
+            player_uuid = mc_username_to_uuid(username)
+            message = to_discord_chat(original_message)
+            relay_from_minecraft({
                 'username': username,
-                'avatar_url':  "https://visage.surgeplay.com/face/160/{}".format(player_uuid),
-                'content': '{}'.format(message)
-            }
-            for webhook in WEBHOOKS:
-                post = requests.post(webhook, json=webhook_payload)
+                'avatar_url': get_avatar_url(player_uuid),
+                'content': message
+            })
             if config.es_enabled:
                 el.log_chat_message(
                     uuid=player_uuid, display_name=username, message=original_message, message_unformatted=chat_string)
@@ -394,124 +680,134 @@ def main():
     @discord_bot.event
     async def on_ready():
         log.info("Discord bot logged in as {} ({})".format(discord_bot.user.name, discord_bot.user.id))
-        global WEBHOOKS
-        WEBHOOKS = []
-        session = database_session.get_session()
-        channels = session.query(DiscordChannel).all()
-        session.close()
-        for channel in channels:
-            channel_id = channel.channel_id
-            discord_channel = discord_bot.get_channel(channel_id)
-            channel_webhooks = await discord_channel.webhooks()
-            found = False
-            for webhook in channel_webhooks:
-                if webhook.name == "_minecraft":
-                    WEBHOOKS.append(webhook.url)
-                    found = True
-                log.debug("Found webhook {} in channel {}".format(webhook.name, discord_channel.name))
-            if not found:
-                # Create the hook
-                await discord_channel.create_webhook(name="_minecraft")
+        global CHANNEL_WEBHOOKS, BRIDGED_CHANNELS, WEBHOOK_SESSION
+        if WEBHOOK_SESSION is None:
+            WEBHOOK_SESSION = aiohttp.ClientSession()
+        with database_session.session_scope() as session:
+            channels = session.query(DiscordChannel).all()
+        BRIDGED_CHANNELS = frozenset(channel.channel_id for channel in channels)
+        # Webhook URLs are stable, so the stored ones are used as-is without asking Discord
+        CHANNEL_WEBHOOKS = {
+            channel.channel_id: webhook_from_url(channel.webhook_url) for channel in channels if channel.webhook_url}
+        # Channels bridged before URLs were stored are looked up (concurrently) once and remembered
+        missing = [channel.channel_id for channel in channels if not channel.webhook_url]
+        channel_webhooks = await gather_logged(
+            [fetch_channel_webhook(discord_bot.get_channel(channel_id)) for channel_id in missing],
+            "look up a channel webhook")
+        for channel_id, webhook in zip(missing, channel_webhooks):
+            if webhook is not None:
+                remember_channel_webhook(channel_id, webhook)
+
+    async def run_outbound_queue(channel_id, queue):
+        bucket = TokenBucket(WEBHOOK_RATE, WEBHOOK_RATE_PERIOD)
+        while True:
+            batch = [await queue.get()]
+            # Give a burst a moment to build up so it goes out in as few requests as possible
+            await asyncio.sleep(OUTBOUND_FLUSH_INTERVAL)
+            while len(batch) < OUTBOUND_BATCH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            # Don't recreate the webhook of a channel that was unbridged while these were waiting
+            if channel_id not in BRIDGED_CHANNELS:
+                continue
+            for message in coalesce_messages(batch):
+                await bucket.acquire()
+                try:
+                    await send_channel_webhook(channel_id, **message)
+                except Exception as e:
+                    log.error("Failed to relay a message to discord: {}".format(e), exc_info=True)
+
+    async def send_channel_webhook(channel_id, **kwargs):
+        webhook = CHANNEL_WEBHOOKS.get(channel_id)
+        if webhook is None:
+            webhook = await fetch_channel_webhook(discord_bot.get_channel(channel_id))
+            remember_channel_webhook(channel_id, webhook)
+        try:
+            await webhook.send(**kwargs)
+        except discord.errors.NotFound:
+            # Someone deleted the webhook, set up a new one and try again
+            CHANNEL_WEBHOOKS.pop(channel_id, None)
+            webhook = await fetch_channel_webhook(discord_bot.get_channel(channel_id))
+            remember_channel_webhook(channel_id, webhook)
+            await webhook.send(**kwargs)
 
     @discord_bot.event
     async def on_message(message):
-        # We do not want the bot to reply to itself
-        if message.author == discord_bot.user:
+        global BRIDGED_CHANNELS, PREVIOUS_MESSAGE, NEXT_MESSAGE_TIME
+        # We do not want the bot to reply to itself, and relayed minecraft chat comes back in through the webhook
+        if message.author.id == discord_bot.user.id or message.webhook_id is not None:
             return
         this_channel = message.channel.id
-        global WEBHOOKS
 
         # PM Commands
         if message.content.startswith("mc!help"):
             try:
                 send_channel = message.channel
-                if isinstance(message.channel, discord.abc.GuildChannel):
+                if isinstance(message.channel, discord.TextChannel):
                     await message.delete()
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    send_channel = message.author.dm_channel
+                    send_channel = await get_dm_channel(message.author)
                 msg = get_discord_help_string()
                 await send_channel.send(msg)
             except discord.errors.Forbidden:
-                if isinstance(message.author, discord.abc.User):
+                if isinstance(message.author, USER_TYPES):
                     msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                    error_msg = await message.channel.send(msg)
-                    await asyncio.sleep(3)
-                    await error_msg.delete()
-            finally:
-                return
+                    await message.channel.send(msg, delete_after=3)
 
         elif message.content.startswith("mc!register"):
             try:
                 # TODO: Catch the Forbidden error in a smart way before running application logic
                 send_channel = message.channel
-                if isinstance(message.channel, discord.abc.GuildChannel):
+                if isinstance(message.channel, discord.TextChannel):
                     await message.delete()
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    send_channel = message.author.dm_channel
-                session = database_session.get_session()
-                discord_account = session.query(DiscordAccount).filter_by(discord_id=message.author.id).first()
-                if not discord_account:
-                    new_discord_account = DiscordAccount(message.author.id)
-                    session.add(new_discord_account)
-                    session.commit()
+                    send_channel = await get_dm_channel(message.author)
+                with database_session.session_scope() as session:
                     discord_account = session.query(DiscordAccount).filter_by(discord_id=message.author.id).first()
-
-                new_token = generate_random_auth_token(16)
-                account_link_token = AccountLinkToken(message.author.id, new_token)
-                discord_account.link_token = account_link_token
-                session.add(account_link_token)
-                session.commit()
+                    if not discord_account:
+                        new_discord_account = DiscordAccount(message.author.id)
+                        session.add(new_discord_account)
+                        session.commit()
+                        discord_account = session.query(DiscordAccount).filter_by(discord_id=message.author.id).first()
+
+                    new_token = generate_random_auth_token(16)
+                    account_link_token = AccountLinkToken(message.author.id, new_token)
+                    discord_account.link_token = account_link_token
+                    session.add(account_link_token)
+                    session.commit()
                 msg = "Please connect your minecraft account to `{}.{}:{}` in order to link it to this bridge!"\
                     .format(new_token, config.auth_dns, config.auth_port)
-                session.close()
-                del session
                 await send_channel.send(msg)
             except discord.errors.Forbidden:
-                if isinstance(message.author, discord.abc.User):
+                if isinstance(message.author, USER_TYPES):
                     msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                    error_msg = await message.channel.send(msg)
-                    await asyncio.sleep(3)
-                    await error_msg.delete()
-            finally:
-                return
+                    await message.channel.send(msg, delete_after=3)
 
         # Global Commands
         elif message.content.startswith("mc!chathere"):
-            if isinstance(message.channel, discord.abc.PrivateChannel):
+            if isinstance(message.channel, PRIVATE_CHANNEL_TYPES):
                 msg = "Sorry, this command is only available in public channels."
                 await message.channel.send(msg)
                 return
             if message.author.id not in config.admin_users:
                 await message.delete()
                 try:
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    dm_channel = message.author.dm_channel
+                    dm_channel = await get_dm_channel(message.author)
                     msg = "Sorry, you do not have permission to execute that command!"
                     await dm_channel.send(msg)
                 except discord.errors.Forbidden:
-                    if isinstance(message.author, discord.abc.User):
+                    if isinstance(message.author, USER_TYPES):
                         msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                        error_msg = await message.channel.send(msg)
-                        await asyncio.sleep(3)
-                        await error_msg.delete()
-                finally:
-                    return
-            session = database_session.get_session()
-            channels = session.query(DiscordChannel).filter_by(channel_id=this_channel).all()
+                        await message.channel.send(msg, delete_after=3)
+                return
+            with database_session.session_scope() as session:
+                channels = session.query(DiscordChannel).filter_by(channel_id=this_channel).all()
             if not channels:
-                new_channel = DiscordChannel(this_channel)
-                session.add(new_channel)
-                session.commit()
-                session.close()
-                del session
-                webhook = await message.channel.create_webhook(name="_minecraft")
-                WEBHOOKS.append(webhook.url)
+                # The session isn't held open while waiting on discord for the webhook
+                webhook = await fetch_channel_webhook(message.channel)
+                with database_session.session_scope() as session:
+                    new_channel = DiscordChannel(this_channel, webhook.url)
+                    session.add(new_channel)
+                    session.commit()
+                BRIDGED_CHANNELS = BRIDGED_CHANNELS | {this_channel}
+                CHANNEL_WEBHOOKS[this_channel] = webhook
                 msg = "The bot will now start chatting here! To stop this, run `mc!stopchathere`."
                 await message.channel.send(msg)
             else:
@@ -520,35 +816,28 @@ def main():
                 return
 
         elif message.content.startswith("mc!stopchathere"):
-            if isinstance(message.channel, discord.abc.PrivateChannel):
+            if isinstance(message.channel, PRIVATE_CHANNEL_TYPES):
                 msg = "Sorry, this command is only available in public channels."
                 await message.channel.send(msg)
                 return
             if message.author.id not in config.admin_users:
                 await message.delete()
                 try:
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    dm_channel = message.author.dm_channel
+                    dm_channel = await get_dm_channel(message.author)
                     msg = "Sorry, you do not have permission to execute that command!"
                     await dm_channel.send(msg)
                 except discord.errors.Forbidden:
-                    if isinstance(message.author, discord.abc.User):
+                    if isinstance(message.author, USER_TYPES):
                         msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                        error_msg = await message.channel.send(msg)
-                        await asyncio.sleep(3)
-                        await error_msg.delete()
-                finally:
-                    return
-            session = database_session.get_session()
-            deleted = session.query(DiscordChannel).filter_by(channel_id=this_channel).delete()
-            session.commit()
-            session.close()
-            for webhook in message.channel:
-                if webhook.name == "_minecraft":
-                    del WEBHOOKS[webhook.url]
-                    await webhook.delete()
+                        await message.channel.send(msg, delete_after=3)
+                return
+            with database_session.session_scope() as session:
+                deleted = session.query(DiscordChannel).filter_by(channel_id=this_channel).delete()
+                session.commit()
+            BRIDGED_CHANNELS = BRIDGED_CHANNELS - {this_channel}
+            webhook = CHANNEL_WEBHOOKS.pop(this_channel, None)
+            if webhook:
+                await webhook.delete()
             if deleted < 1:
                 msg = "The bot was not chatting here!"
                 await message.channel.send(msg)
@@ -561,149 +850,116 @@ def main():
         elif message.content.startswith("mc!tab"):
             send_channel = message.channel
             try:
-                if isinstance(message.channel, discord.abc.GuildChannel):
+                if isinstance(message.channel, discord.TextChannel):
                     await message.delete()
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    send_channel = message.author.dm_channel
-                player_list = ", ".join(list(map(lambda x: x[1], PLAYER_LIST.items())))
+                    send_channel = await get_dm_channel(message.author)
                 msg = "{}\n" \
                     "Players online: {}\n" \
-                    "{}".format(escape_markdown(
-                        strip_colour(TAB_HEADER)), escape_markdown(
-                        strip_colour(player_list)), escape_markdown(
-                        strip_colour(TAB_FOOTER)))
+                    "{}".format(TAB_HEADER_DISPLAY, get_player_list_display(), TAB_FOOTER_DISPLAY)
                 await send_channel.send(msg)
             except discord.errors.Forbidden:
-                if isinstance(message.author, discord.abc.User):
+                if isinstance(message.author, USER_TYPES):
                     msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                    error_msg = await message.channel.send(msg)
-                    await asyncio.sleep(3)
-                    await error_msg.delete()
-            finally:
-                return
+                    await message.channel.send(msg, delete_after=3)
 
         elif message.content.startswith("mc!"):
             # Catch-all
             send_channel = message.channel
             try:
-                if isinstance(message.channel, discord.abc.GuildChannel):
+                if isinstance(message.channel, discord.TextChannel):
                     await message.delete()
-                    dm_channel = message.author.dm_channel
-                    if not dm_channel:
-                        await message.author.create_dm()
-                    send_channel = message.author.dm_channel
+                    send_channel = await get_dm_channel(message.author)
                 msg = "Unknown command, type `mc!help` for a list of commands."
                 await send_channel.send(msg)
             except discord.errors.Forbidden:
-                if isinstance(message.author, discord.abc.User):
+                if isinstance(message.author, USER_TYPES):
                     msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                    error_msg = await message.channel.send(msg)
-                    await asyncio.sleep(3)
-                    await error_msg.delete()
-            finally:
-                return
+                    await message.channel.send(msg, delete_after=3)
             
-        elif not message.author.bot:
-            session = database_session.get_session()
-            channel_should_chat = session.query(DiscordChannel).filter_by(channel_id=this_channel).first()
-            if channel_should_chat:
-                await message.delete()
+        elif not message.author.bot and this_channel in BRIDGED_CHANNELS:
+            await message.delete()
+            with database_session.session_scope() as session:
                 discord_user = session.query(DiscordAccount).filter_by(discord_id=message.author.id).first()
-                if discord_user:
-                    if discord_user.minecraft_account:
-                        minecraft_uuid = discord_user.minecraft_account.minecraft_uuid
-                        session.close()
-                        del session
-                        minecraft_username = mc_uuid_to_username(minecraft_uuid)
-
-                        # Max chat message length: 256, bot username does not count towards this
-                        # Does not count|Counts
-                        # <BOT_USERNAME> minecraft_username: message
-                        padding = 2 + len(minecraft_username)
-
-                        message_to_send = remove_emoji(
-                            message.clean_content.encode('utf-8').decode('ascii', 'replace')).strip()
-                        message_to_discord = escape_markdown(message.clean_content)
-
-                        total_len = padding + len(message_to_send)
-                        if total_len > 256:
-                            message_to_send = message_to_send[:(256 - padding)]
-                            message_to_discord = message_to_discord[:(256 - padding)]
-                        elif len(message_to_send) <= 0:
-                            return
-
-                        session = database_session.get_session()
-                        channels = session.query(DiscordChannel).all()
-                        session.close()
-                        del session
-                        global PREVIOUS_MESSAGE, NEXT_MESSAGE_TIME
-                        if message_to_send == PREVIOUS_MESSAGE or \
-                                datetime.now(timezone.utc) < NEXT_MESSAGE_TIME:
-                            send_channel = message.channel
-                            try:
-                                if isinstance(message.channel, discord.abc.GuildChannel):
-                                    dm_channel = message.author.dm_channel
-                                    if not dm_channel:
-                                        await message.author.create_dm()
-                                    send_channel = message.author.dm_channel
-                                msg = "Your message \"{}\" has been rate-limited.".format(message.clean_content)
-                                await send_channel.send(msg)
-                            except discord.errors.Forbidden:
-                                if isinstance(message.author, discord.abc.User):
-                                    msg = "{}, please allow private messages from this bot.".format(
-                                        message.author.mention)
-                                    error_msg = await message.channel.send(msg)
-                                    await asyncio.sleep(3)
-                                    await error_msg.delete()
-                            finally:
-                                return
-
-                        PREVIOUS_MESSAGE = message_to_send
-                        NEXT_MESSAGE_TIME = datetime.now(timezone.utc) + timedelta(seconds=config.message_delay)
-
-                        log.info("Outgoing message from discord: Username: {} Message: {}".format(minecraft_username, message_to_send))
-
-                        for channel in channels:
-                            webhooks = await discord_bot.get_channel(channel.channel_id).webhooks()
-                            for webhook in webhooks:
-                                if webhook.name == "_minecraft":
-                                    await webhook.send(
-                                        username=minecraft_username,
-                                        avatar_url="https://visage.surgeplay.com/face/160/{}".format(minecraft_uuid),
-                                        content=message_to_discord)
-
-                        packet = serverbound.play.ChatPacket()
-                        packet.message = "{}: {}".format(minecraft_username, message_to_send)
-                        connection.write_packet(packet)
-                else:
-                    send_channel = message.channel
-                    try:
-                        if isinstance(message.channel, discord.abc.GuildChannel):
-                            dm_channel = message.author.dm_channel
-                            if not dm_channel:
-                                await message.author.create_dm()
-                            send_channel = message.author.dm_channel
-                        msg = "Unable to send chat message: there is no Minecraft account linked to this discord account," \
-                              "please run `mc!register`."
-                        await send_channel.send(msg)
-                    except discord.errors.Forbidden:
-                        if isinstance(message.author, discord.abc.User):
-                            msg = "{}, please allow private messages from this bot.".format(message.author.mention)
-                            error_msg = await message.channel.send(msg)
-                            await asyncio.sleep(3)
-                            await error_msg.delete()
-                    finally:
-                        session.close()
-                        del session
-                        return
-            else:
-                session.close()
-                del session
+                minecraft_account = discord_user.minecraft_account if discord_user else None
+                minecraft_uuid = minecraft_account.minecraft_uuid if minecraft_account else None
+            # Covers both users who never ran mc!register and those who haven't joined the auth server yet
+            if not minecraft_uuid:
+                send_channel = message.channel
+                try:
+                    if isinstance(message.channel, discord.TextChannel):
+                        send_channel = await get_dm_channel(message.author)
+                    msg = "Unable to send chat message: there is no Minecraft account linked to this discord account," \
+                          "please run `mc!register`."
+                    await send_channel.send(msg)
+                except discord.errors.Forbidden:
+                    if isinstance(message.author, USER_TYPES):
+                        msg = "{}, please allow private messages from this bot.".format(message.author.mention)
+                        await message.channel.send(msg, delete_after=3)
+                return
+
+            # A cache miss is a blocking round trip to Mojang, keep it off the event loop
+            minecraft_username = await asyncio.get_running_loop().run_in_executor(
+                None, mc_uuid_to_username, minecraft_uuid)
+            if minecraft_username is None:
+                send_channel = message.channel
+                try:
+                    if isinstance(message.channel, discord.TextChannel):
+                        send_channel = await get_dm_channel(message.author)
+                    msg = "Your message \"{}\" could not be sent because your Minecraft username could not be " \
+                          "looked up, please try again later.".format(message.clean_content)
+                    await send_channel.send(msg)
+                except discord.errors.Forbidden:
+                    if isinstance(message.author, USER_TYPES):
+                        msg = "{}, please allow private messages from this bot.".format(message.author.mention)
+                        await message.channel.send(msg, delete_after=3)
+                return
+
+            # Max chat message length: 256, bot username does not count towards this
+            # Does not count|Counts
+            # <BOT_USERNAME> minecraft_username: message
+            padding = 2 + len(minecraft_username)
+
+            message_to_send = to_minecraft_chat(message.clean_content)
+            message_to_discord = escape_markdown(message.clean_content)
+
+            total_len = padding + len(message_to_send)
+            if total_len > 256:
+                message_to_send = message_to_send[:(256 - padding)]
+                message_to_discord = message_to_discord[:(256 - padding)]
+            elif len(message_to_send) <= 0:
+                return
+
+            if message_to_send == PREVIOUS_MESSAGE or \
+                    datetime.now(timezone.utc) < NEXT_MESSAGE_TIME:
+                send_channel = message.channel
+                try:
+                    if isinstance(message.channel, discord.TextChannel):
+                        send_channel = await get_dm_channel(message.author)
+                    msg = "Your message \"{}\" has been rate-limited.".format(message.clean_content)
+                    await send_channel.send(msg)
+                except discord.errors.Forbidden:
+                    if isinstance(message.author, USER_TYPES):
+                        msg = "{}, please allow private messages from this bot.".format(
+                            message.author.mention)
+                        await message.channel.send(msg, delete_after=3)
+                return
+
+            PREVIOUS_MESSAGE = message_to_send
+            NEXT_MESSAGE_TIME = datetime.now(timezone.utc) + timedelta(seconds=config.message_delay)
+
+            log.info("Outgoing message from discord: Username: %s Message: %s", minecraft_username, message_to_send)
+
+            queue_bridged_message({
+                'username': minecraft_username,
+                'avatar_url': get_avatar_url(minecraft_uuid),
+                'content': message_to_discord
+            })
+
+            await asyncio.get_running_loop().run_in_executor(
+                MINECRAFT_WRITER, write_chat_packet, connection, f"{minecraft_username}: {message_to_send}")
 
     discord_bot.run(config.discord_token)
 
 
 if __name__ == "__main__":
-main()
+    main()